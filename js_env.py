@@ -1,36 +1,27 @@
 import re
 import os
 import shlex
+import shutil
 import subprocess
 import datetime
 import configparser
 import argparse
-from glob import glob
+import itertools
+import selectors
+import queue
+import time
+import traceback
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
 from flask import Flask
-from threading import Thread
+from threading import Thread, Lock
 
 
 def which(program):
-    """
-    This function is taken from
-    http://stackoverflow.com/questions/377017/test-if-executable-exists-in-python
-    """
-    def is_exe(fpath):
-        return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
-    fpath, fname = os.path.split(program)
-    if fpath:
-        if is_exe(program):
-            return program
-    else:
-        for path in os.environ["PATH"].split(os.pathsep):
-            path = path.strip('"')
-            exe_file = os.path.join(path, program)
-            if is_exe(exe_file):
-                return exe_file
-    return None
+    """Return the path to the executable `program` if it is found in PATH,
+    else `None`."""
+    return shutil.which(program)
 
 
 class Singleton:
@@ -76,17 +67,54 @@ class Singleton:
         return isinstance(inst, self._decorated)
 
 
+_config_cache = {}
+_config_cache_lock = Lock()
+
+
+def _read_config_cached(path):
+    """Read and parse the config file at `path`, reusing the previous parse
+    if the file hasn't changed since.
+
+    The file is considered unchanged if its `(st_mtime_ns, st_size, st_ino)`
+    are the same. In place edits change the mtime and atomic replacements
+    change the inode.
+
+    :param path: Path of the config file
+    :returns: Parsed config
+    :rtype: :class:`configparser.ConfigParser`
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        sig = None
+    else:
+        sig = (st.st_mtime_ns, st.st_size, st.st_ino)
+    with _config_cache_lock:
+        cached = _config_cache.get(path)
+        if sig is not None and cached is not None and cached[0] == sig:
+            return cached[1]
+        conf = configparser.ConfigParser()
+        conf.optionxform = str
+        conf.read(path)
+        if sig is not None:
+            _config_cache[path] = (sig, conf)
+        return conf
+
+
 class Configuration:
     def __init__(self):
-        self._conf = configparser.ConfigParser()
-        self._conf.optionxform = str
-        self._conf.read('.js_env_config')
+        self._conf = _read_config_cached('.js_env_config')
         self._excluded_regex = []
         self._excluded_extensions = []
         self._included_extensions = []
         self._excluded_files = []
         self._excluded_folders = ["node_modules"]
         self._commands = ["build", "serve", "start", "test"]
+        self._watched_cache = None
+        self._watched_dir_mtime = 0
+        self._watched_gen = 0
+        self._watched_lock = Lock()
+        self._recompile()
         assert "commands" in self._conf
         assert "server" in self._conf
         assert all([c in self._conf["commands"] for c in self._commands])
@@ -117,90 +145,282 @@ class Configuration:
 
     def set_included_extensions(self, included_file_extensions):
         self._included_extensions = included_file_extensions
+        self._recompile()
 
     def set_excluded_extensions(self, excluded_file_extensions):
         self._excluded_extensions = excluded_file_extensions
+        self._recompile()
 
     def set_excluded_regex(self, excluded_filters):
         self._excluded_regex = excluded_filters
+        self._recompile()
 
     def set_excluded_files(self, excluded_files):
         self._excluded_files = excluded_files
+        self._recompile()
 
     def set_excluded_folders(self, excluded_folders):
         self._excluded_folders = excluded_folders
+        self._recompile()
+
+    def _recompile(self):
+        """Precompute the watch filters so that :meth:`is_watched` does as
+        few checks as possible.
+
+        Extensions are kept as tuples for :meth:`str.endswith` and excluded
+        folders as a set for pruning the traversal. Excluded folder and file
+        substrings and the excluded regexes are fused into one pattern, or
+        `None` if there are none. Regexes with groups or flags are compiled
+        separately instead, as fusing would renumber their groups or apply
+        their flags to the whole pattern.
+        """
+        alternatives = [re.escape(x) for x in
+                        self._excluded_folders + self._excluded_files if x]
+        self._exc_regex_compiled = []
+        for regex in self._excluded_regex:
+            if regex:
+                pattern = re.compile(regex)
+                if pattern.groups or pattern.flags != re.UNICODE:
+                    self._exc_regex_compiled.append(pattern)
+                else:
+                    alternatives.append("(?:%s)" % regex)
+        self._exc_re = re.compile("|".join(alternatives)) if alternatives else None
+        self._inc_ext_tuple = tuple(e for e in self._included_extensions if e)
+        self._exc_ext_tuple = tuple(e for e in self._excluded_extensions if e)
+        self._excluded_folders_set = frozenset(self._excluded_folders)
+        self.invalidate_watched()
 
     # is_watched requires full relative filepath
     def is_watched(self, filepath):
-        watched = False
-        for ext in self._included_extensions:
-            if filepath.endswith(ext):
-                watched = True
-        for ext in self._excluded_extensions:
-            if filepath.endswith(ext):
-                watched = False
-        for folder in self._excluded_folders:
-            if folder in filepath:
-                watched = False
-        for fn in self._excluded_files:
-            if fn in filepath:
-                watched = False
-        for regex in self._excluded_regex:
-            if re.findall(regex, filepath):
-                watched = False
-        return watched
+        # Cheapest and most selective checks first
+        if not self._excluded_folders_set.isdisjoint(filepath.split(os.sep)):
+            return False
+        if filepath.endswith(self._exc_ext_tuple):
+            return False
+        if self._exc_re and self._exc_re.search(filepath):
+            return False
+        if any(p.search(filepath) for p in self._exc_regex_compiled):
+            return False
+        return filepath.endswith(self._inc_ext_tuple)
+
+    def _scandir_filtered(self, path="."):
+        """Recursively yield the watched files under `path`.
+
+        Folders in self._excluded_folders are skipped without descending
+        into them, and each file is filtered with :meth:`is_watched` as it
+        is found. As with `glob`, hidden files and folders are skipped below
+        the first level, and so are folders which can't be read. Symlinks to
+        folders aren't followed, so the walk needs no `stat` beyond what
+        :func:`os.scandir` returns and can't loop.
+
+        :param path: Directory to scan
+        :returns: Generator of relative filepaths
+        """
+        top = path == "."
+        try:
+            it = os.scandir(path)
+        except OSError:
+            # Like `glob`, skip folders which can't be read or are gone
+            if top:
+                raise
+            return
+        with it:
+            for entry in it:
+                if not top and entry.name.startswith("."):
+                    continue
+                filepath = entry.name if top else entry.path
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    is_file = not is_dir and entry.is_file()
+                except OSError:
+                    continue
+                if is_dir:
+                    if entry.name not in self._excluded_folders_set:
+                        yield from self._scandir_filtered(filepath)
+                elif is_file and self.is_watched(filepath):
+                    yield filepath
+
+    def invalidate_watched(self):
+        """Discard the files cached by :meth:`get_watched`."""
+        with self._watched_lock:
+            self._watched_gen += 1
+            self._watched_cache = None
 
-    # TODO: This should be cached maybe
     def get_watched(self):
-        """Get all the watched files, except for the first level folders
+        """Get all the watched files, except for those in the folders
         in self._excluded_folders
 
+        The result is cached until the mtime of the current directory
+        changes or :meth:`invalidate_watched` is called, e.g., when files
+        are created or deleted in subfolders. A scan during which the cache
+        is invalidated isn't cached.
+
         :returns: Watched Files
         :rtype: list
         """
-        all_files = [x for x in os.listdir(".") if os.path.isfile(x)]
-        all_folders = [x for x in os.listdir(".") if os.path.isdir(x)]
-        for x in all_folders:
-            if x not in self._excluded_folders:
-                all_files.extend(glob(x + '/**', recursive=True))
-        elements = [f for f in all_files if self.is_watched(f)]
-        return elements
+        mtime = os.stat(".").st_mtime_ns
+        with self._watched_lock:
+            if self._watched_cache is not None and mtime == self._watched_dir_mtime:
+                return list(self._watched_cache)
+            gen = self._watched_gen
+        watched = list(self._scandir_filtered())
+        with self._watched_lock:
+            if gen == self._watched_gen:
+                self._watched_cache = tuple(watched)
+                self._watched_dir_mtime = mtime
+        return watched
+
+    def is_watched_folder(self, name):
+        """Whether the first level folder `name` should be watched."""
+        return name not in self._excluded_folders_set
 
+    def get_watched_folders(self):
+        """Get the first level folders which should be watched recursively,
+        i.e., all except those in self._excluded_folders. Symlinks to folders
+        aren't followed, same as in :meth:`get_watched`.
 
-def getext(filename):
-    "Get the file extension."
-    return os.path.splitext(filename)[-1].lower()
+        :returns: Watched Folders
+        :rtype: list
+        """
+        with os.scandir(".") as it:
+            return [entry.name for entry in it
+                    if entry.is_dir(follow_symlinks=False) and
+                    self.is_watched_folder(entry.name)]
 
 
 def get_now():
     return datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S")
 
 
+# Commands with any of these characters or starting with variable
+# assignments have to be run through the shell
+_shell_chars_re = re.compile(r"[|&;<>()$`*?\[\]{}~#!\n]|^\s*[A-Za-z_][A-Za-z0-9_]*=")
+
+
+def spawn_command(command):
+    """Start `command` without waiting for it to finish.
+
+    Commands which need the shell (pipes, `&&`, redirections, globs,
+    variable assignments etc.) are run with `shell=True`, others are split
+    into an argv list and executed directly, which saves spawning a shell.
+    If the direct exec fails, e.g., for a missing program, the error is
+    reported and the command is run through the shell after all, so that
+    it fails the same way with exit status 127.
+
+    :param command: Command string
+    :returns: Started process
+    :rtype: :class:`subprocess.Popen`
+    """
+    if not _shell_chars_re.search(command):
+        try:
+            return subprocess.Popen(shlex.split(command))
+        except (OSError, ValueError) as e:
+            print("Could not run \"%s\" directly: %s" % (command, e))
+    return subprocess.Popen(command, shell=True)
+
+
+class Reaper:
+    """Wait on started processes from a single thread so that they don't
+    linger as zombies after exiting.
+
+    On Linux the processes are watched with `pidfd`s on a selector, so the
+    thread is woken up by the kernel when any of them exits. Elsewhere a
+    thread waits on each process.
+    """
+
+    def __init__(self):
+        self._selector = None
+        self._lock = Lock()
+
+    def watch(self, p):
+        try:
+            pidfd = os.pidfd_open(p.pid)
+        except (AttributeError, OSError):
+            Thread(target=p.wait, daemon=True).start()
+            return
+        with self._lock:
+            if self._selector is None:
+                self._selector = selectors.DefaultSelector()
+                Thread(target=self._run, daemon=True).start()
+            self._selector.register(pidfd, selectors.EVENT_READ, p)
+
+    def _run(self):
+        while True:
+            for key, _ in self._selector.select():
+                with self._lock:
+                    self._selector.unregister(key.fd)
+                os.close(key.fd)
+                key.data.wait()
+
+
+_reaper = Reaper()
+_jobs = {}
+_jobs_lock = Lock()
+_max_jobs = 100
+_job_ids = itertools.count(1)
+
+
+def start_job(command):
+    """Start `command` in the background and return its job id, which can
+    be queried with :func:`job_status`. Only the last `_max_jobs` jobs
+    are kept.
+
+    :param command: Command string
+    :returns: Job id
+    :rtype: str
+    """
+    p = spawn_command(command)
+    _reaper.watch(p)
+    with _jobs_lock:
+        jid = str(next(_job_ids))
+        _jobs[jid] = p
+        # Only the latest jobs are kept, the processes are reaped regardless
+        while len(_jobs) > _max_jobs:
+            del _jobs[next(iter(_jobs))]
+    return jid
+
+
+def job_status(jid):
+    """Get the status of the job `jid` started by :func:`start_job`.
+
+    :param jid: Job id
+    :returns: Status of the job or `None` if there's no such job
+    :rtype: str
+    """
+    with _jobs_lock:
+        p = _jobs.get(jid)
+    if p is None:
+        return None
+    if p.poll() is None:
+        return "Running"
+    return "Exited with %d" % p.returncode
+
+
 def build():
     print("Running build", config.build_command)
     if config.build_command:
-        subprocess.run(config.build_command, shell=True)
+        return "Building, job %s" % start_job(config.build_command)
     return "Building"
 
 
 def test():
     print("Running \"test\"")
     if config.test_command:
-        subprocess.run(shlex.split(config.test_command), shell=True)
+        return "Testing, job %s" % start_job(config.test_command)
     return "Testing"
 
 
 def start():
     print("Running \"start\"")
     if config.start_command:
-        subprocess.run(shlex.split(config.start_command), shell=True)
+        return "Starting, job %s" % start_job(config.start_command)
     return "Starting"
 
 
 def run():
     print("Running \"run\"")
     if config.run_command:
-        subprocess.run(shlex.split(config.run_command), shell=True)
+        return "Running, job %s" % start_job(config.run_command)
     return "Running"
 
 
@@ -210,44 +430,124 @@ def run():
 def serve():
     print("Running \"serve\"")
     if config.run_command:
-        subprocess.run(config.serve_command, shell=True)
+        return "Serving, job %s" % start_job(config.serve_command)
     return "Serving"
 
 
 class ChangeHandler(FileSystemEventHandler):
-    def __init__(self, root='.'):
+    def __init__(self, root='.', delay=0.1):
         self.root = root
         self.config = config
+        self.delay = delay
+        self._pwd = os.path.abspath(root) + os.sep
+        self._queue = queue.SimpleQueue()
+        self._observer = None
+        self._watches = {}
+        Thread(target=self._build_worker, daemon=True).start()
+
+    def schedule(self, observer):
+        """Schedule self on `observer` for the files in the root and,
+        recursively, for the watched first level folders.
+
+        Excluded folders are never scheduled so their events don't reach us
+        at all. Folders created in or removed from the root later are
+        scheduled or unscheduled as their events arrive.
+
+        `observer` should already be started, so that a folder which can't
+        be watched raises here and is skipped, instead of failing the
+        observer.
+        """
+        self._observer = observer
+        observer.schedule(self, os.path.abspath(self.root), recursive=False)
+        for folder in self.config.get_watched_folders():
+            self._watch_folder(os.path.join(self._pwd, folder))
+
+    def _is_root_folder(self, event, path):
+        return (self._observer is not None and event.is_directory and
+                os.path.dirname(path) + os.sep == self._pwd)
+
+    def _watch_folder(self, path):
+        if self.config.is_watched_folder(os.path.basename(path)):
+            self._unwatch_folder(path)
+            try:
+                self._watches[path] = self._observer.schedule(self, path, recursive=True)
+            except OSError as e:
+                # e.g., the folder was removed again before we got to it
+                print("Not watching " + path + ": " + str(e))
+
+    def _unwatch_folder(self, path):
+        watch = self._watches.pop(path, None)
+        if watch is not None:
+            try:
+                self._observer.unschedule(watch)
+            except KeyError:
+                pass
 
-    def _build_if_watched(self, filepath):
+    def _build_worker(self):
+        """Collect the paths of events into batches and run one build per
+        batch if any of them is watched.
+
+        A batch ends when no new event arrives for `self.delay` seconds, so
+        that a burst of events triggers only one build and the watchdog
+        thread is never blocked by the checks. The build is waited on before
+        the next batch, so that builds don't run concurrently.
+        """
+        while True:
+            paths = [self._queue.get()]
+            try:
+                while True:
+                    time.sleep(self.delay)
+                    if self._queue.empty():
+                        break
+                    while not self._queue.empty():
+                        paths.append(self._queue.get_nowait())
+                if any(self._is_watched(p) for p in set(paths)):
+                    self._build()
+            except Exception:
+                print("Error while building for changes in", paths)
+                traceback.print_exc()
+
+    def _build(self):
+        print("Running build", self.config.build_command)
+        if self.config.build_command:
+            spawn_command(self.config.build_command).wait()
+
+    def _is_watched(self, filepath):
         if os.path.isfile(filepath):
-            pwd = os.path.abspath(self.root) + '/'
-            # print("filepath", filepath, pwd, pwd in filepath)
-            filepath = str(filepath)
-            assert pwd in filepath
-            filepath = filepath.replace(pwd, '')
-            watched = self.config.is_watched(filepath)
-            if watched:
+            filepath = os.fspath(filepath)
+            if filepath.startswith(self._pwd):
+                filepath = filepath[len(self._pwd):]
+            if self.config.is_watched(filepath):
                 print("file " + filepath + " is watched")
-                build()
-            else:
-                # print("file " + filepath + " is not watched")
-                pass
-        else:
-            # print(filepath + " is not a file")
-            pass
+                return True
+        return False
 
     def on_created(self, event):
         print("file " + event.src_path + " created")
-        self._build_if_watched(event.src_path)
+        self.config.invalidate_watched()
+        if self._is_root_folder(event, event.src_path):
+            self._watch_folder(event.src_path)
+        self._queue.put(event.src_path)
 
     def on_modified(self, event):
         print("file " + event.src_path + " modified")
-        self._build_if_watched(event.src_path)
+        self._queue.put(event.src_path)
 
     def on_deleted(self, event):
         print("file " + event.src_path + " deleted")
-        self._build_if_watched(event.src_path)
+        self.config.invalidate_watched()
+        if self._is_root_folder(event, event.src_path):
+            self._unwatch_folder(event.src_path)
+        self._queue.put(event.src_path)
+
+    def on_moved(self, event):
+        print("file " + event.src_path + " moved to " + event.dest_path)
+        self.config.invalidate_watched()
+        if self._is_root_folder(event, event.src_path):
+            self._unwatch_folder(event.src_path)
+        if self._is_root_folder(event, event.dest_path):
+            self._watch_folder(event.dest_path)
+        self._queue.put(event.dest_path)
 
 
 # TODO: Display config.
@@ -318,9 +618,9 @@ def main():
     parse_options()
     if config.live_server:
         print("Starting live server ...")
-        p = subprocess.Popen(['live-server', '--open=build'])
-        t = Thread(target=p.communicate)
-        t.start()
+        # Output is inherited from us, so nothing has to read from it, but
+        # it must be reaped if it exits
+        _reaper.watch(subprocess.Popen(['live-server', '--open=build']))
     else:
         print("Not starting live server ...")
     if config.watchdog:
@@ -328,8 +628,8 @@ def main():
         print("Starting watchdog and watching ", watched_elements)
         event_handler = ChangeHandler()
         observer = Observer()
-        observer.schedule(event_handler, os.getcwd(), recursive=True)
         observer.start()
+        event_handler.schedule(observer)
     else:
         print("Not starting watchdog ...")
 
@@ -356,8 +656,20 @@ def main():
     def __serve():
         return serve()
 
+    @app.route("/status/<jid>", methods=["GET", "POST"])
+    def __status(jid):
+        status = job_status(jid)
+        if status is None:
+            return "No such job %s" % jid, 404
+        return status
+
     print("Starting server on port %s" % str(port))
-    app.run(host="127.0.0.1", port=port)
+    try:
+        from waitress import serve as wsgi_serve
+    except ImportError:
+        app.run(host="127.0.0.1", port=port, threaded=True)
+    else:
+        wsgi_serve(app, host="127.0.0.1", port=port, threads=4)
 
 
 if __name__ == '__main__':